@@ -3,19 +3,35 @@ import os
 import sys
 import csv
 import glob
+import fnmatch
 import yaml
-import json
+import queue
 import time
 import signal
+import gc
 import resource
 import argparse
+import dataclasses
+import functools
+import itertools
+import threading
 import subprocess
 import xml.etree.ElementTree as ET
 
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED
 
-from threading import Lock
-from concurrent.futures import ThreadPoolExecutor
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
 
 MAPPING = {
     "black": 90,
@@ -34,6 +50,8 @@ SUFFIX = "\033[0m"
 
 VRAM_LIMIT = 15 * 1024 * 1024 * 1024
 
+PROGRESS_INTERVAL = 0.02
+
 
 def progress(msg, curr, total, prev=0):
     status = round((curr / total) * 100)
@@ -74,17 +92,6 @@ def indent(msg, prefix=None):
     sys.stdout.flush()
 
 
-class RowLengthDiffersException(Exception):
-    def __init__(self, len1, len2):
-        self.len1 = len1
-        self.len2 = len2
-        self.message = f'Expected row length of \'{len1}\' but got \'{len2}\''
-        super().__init__(self.message)
-
-    def __str__(self):
-        return self.message
-
-
 class CSVTableGenerator:
     def __init__(self, file='result.csv', header=[], memory=False):
         self.file = file
@@ -93,29 +100,46 @@ class CSVTableGenerator:
         self.rsize = len(header)
         self.table = []
 
-        with open(self.file, 'w') as f:
-            writer = csv.writer(f)
-            writer.writerow(self.header)
+        self._fd = open(self.file, 'w', buffering=1 << 20, newline='')
+        self._writer = csv.writer(self._fd)
+        self._writer.writerow(self.header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.commit()
+        self.close()
 
     def clear_table(self):
         if self.memory:
             self.table.clear()
 
     def add_row(self, row):
-        if len(row) != self.rsize:
-            raise RowLengthDiffersException(self.rsize, len(row))
+        assert len(row) == self.rsize, \
+            f'Expected row length of \'{self.rsize}\' but got \'{len(row)}\''
         if self.memory:
             self.table.append(row)
         else:
-            with open(self.file, 'a') as f:
-                writer = csv.writer(f)
-                writer.writerow(row)
+            self._writer.writerow(row)
 
     def commit(self):
         if self.memory:
-            with open(self.file, 'a') as f:
-                writer = csv.writer(f)
-                writer.writerows(self.table)
+            self._writer.writerows(self.table)
+            self.table.clear()
+        self._fd.flush()
+
+    def close(self):
+        self._fd.close()
+
+
+@dataclasses.dataclass(slots=True)
+class TaskSpec:
+    benchmark: str
+    benchmark_file: str
+    output_dir: str
+    bench_dirname: str
+    bench_basename: str
 
 
 def get_parser():
@@ -146,60 +170,81 @@ def parse(argv):
 
 def parse_report(f):
     try:
-        with open(f, "r") as fd:
-            return json.load(fd)
-    except:
+        with open(f, "rb") as fd:
+            return json_loads(fd.read())
+    except (FileNotFoundError, ValueError):
         return {"specification": "Timeout", "solver_time": 0.0,
                 "paths_explored": 0}
 
 
+@functools.lru_cache(maxsize=None)
 def parse_yaml(f):
     with open(f, "r") as fd:
-        return yaml.load(fd, Loader=yaml.SafeLoader)
+        return yaml.load(fd, Loader=SafeLoader)
 
 
+@functools.lru_cache(maxsize=None)
 def parse_list(f):
     with open(f, "r") as fd:
-        data = fd.readlines()
-    return list(map(lambda line: line.strip(),
-                    filter(lambda line: not line.startswith("#"), data)))
+        return tuple(line.strip() for line in fd
+                     if not line.startswith("#") and line.strip())
+
+
+@functools.lru_cache(maxsize=None)
+def list_dir(d):
+    try:
+        with os.scandir(d or ".") as it:
+            return tuple(entry.name for entry in it)
+    except (FileNotFoundError, NotADirectoryError):
+        return ()
+
+
+def find_files(pattern):
+    (d, name) = os.path.split(pattern)
+    if glob.has_magic(d):
+        return glob.glob(pattern)
+    names = list_dir(d)
+    if not glob.has_magic(name):
+        return [pattern] if name in names else []
+    if not name.startswith("."):
+        names = [n for n in names if not n.startswith(".")]
+    return [os.path.join(d, n) for n in fnmatch.filter(names, name)]
 
 
 def parse_tasks(conf):
     tasks = {}
-    root = ET.parse(conf).getroot()
-    for task in root.findall("tasks"):
+    depth = 0
+    for event, task in ET.iterparse(conf, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        # only <tasks> directly under <benchmark>, not inside <rundefinition>
+        if depth != 1 or task.tag != "tasks":
+            continue
         name = task.attrib["name"]
         tasks[name] = set()
         for i in task.findall("includesfile"):
             tasks_sets = parse_list(i.text)
             for tasks_set_file in tasks_sets:
-                if not tasks_set_file:
-                    continue
-                tasks_set = glob.glob(
+                tasks_set = find_files(
                     os.path.join(os.path.dirname(i.text), tasks_set_file)
                 )
-                tasks[name] = tasks[name].union(set(tasks_set))
+                tasks[name].update(tasks_set)
         for i in task.findall("excludesfile"):
             tasks_sets = parse_list(i.text)
             for tasks_set_file in tasks_sets:
-                if not tasks_set_file:
-                    continue
                 if tasks_set_file.startswith("sv-benchmarks"):
-                    tasks_set = glob.glob(tasks_set_file)
+                    tasks_set = find_files(tasks_set_file)
                 else:
-                    tasks_set = glob.glob(
+                    tasks_set = find_files(
                         os.path.join(os.path.dirname(i.text), tasks_set_file)
                     )
-                tasks[name] = tasks[name].difference(set(tasks_set))
+                tasks[name].difference_update(tasks_set)
+        task.clear()
     return tasks
 
 
-def preexec_fn():
-    resource.setrlimit(resource.RLIMIT_AS, (VRAM_LIMIT, VRAM_LIMIT))
-    os.setsid()
-
-
 def execute(benchmark, output_dir, _, prop):
     result = {
         "runtime": 0.0,
@@ -217,117 +262,155 @@ def execute(benchmark, output_dir, _, prop):
     ]
     proc = subprocess.Popen(
         cmd,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        preexec_fn=preexec_fn)
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True)
+    try:
+        resource.prlimit(proc.pid, resource.RLIMIT_AS,
+                         (VRAM_LIMIT, VRAM_LIMIT))
+    except ProcessLookupError:
+        pass
     try:
-        _, _ = proc.communicate(timeout=900.0)
-        report = parse_report(os.path.join(output_dir, "report.json"))
-        result["answer"] = str(report["specification"])
-        result["solver_time"] = float(report["solver_time"])
-        result["paths_explored"] = int(report["paths_explored"])
+        proc.wait(timeout=900.0)
     except subprocess.TimeoutExpired:
-        result["answer"] = "Timeout"
         os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+        result["runtime"] = time.time() - start
+        return result
     result["runtime"] = time.time() - start
+    report = parse_report(os.path.join(output_dir, "report.json"))
+    result["answer"] = str(report["specification"])
+    result["solver_time"] = float(report["solver_time"])
+    result["paths_explored"] = int(report["paths_explored"])
     return result
 
 
-def run_benchmark(lock, conf, benchmark):
-    global prev
-    global curr
-
-    size = conf["size"]
-    prop = conf["prop"]
-    backend = conf["backend"]
-    table = conf["table"]
-    lock.acquire()
-    curr += 1
-    prev = progress(f"Running {benchmark}", curr, size, prev=prev)
-    lock.release()
-
-    benchmark_conf = parse_yaml(benchmark)
-    skip = True
-    for prp in benchmark_conf["properties"]:
-        prop_name = os.path.basename(prop)
-        prp_name = os.path.basename(prp["property_file"])
-        if prop_name == prp_name:
-            skip = False
-            break
-    if skip:
-        return None
+def has_property(bench_conf, prop):
+    prop_name = os.path.basename(prop)
+    for prp in bench_conf["properties"]:
+        if os.path.basename(prp["property_file"]) == prop_name:
+            return True
+    return False
+
 
+def get_task(benchmark, prop):
+    bench_conf = parse_yaml(benchmark)
+    if not has_property(bench_conf, prop):
+        return None
     benchmark_file = os.path.join(os.path.dirname(benchmark),
-                                  benchmark_conf["input_files"])
-    output_dir = os.path.join(
-        "wasp-out",
-        os.path.basename(os.path.dirname(benchmark_file)),
-        os.path.basename(benchmark_file)
+                                  bench_conf["input_files"])
+    bench_dirname = os.path.basename(os.path.dirname(benchmark_file))
+    bench_basename = os.path.basename(benchmark_file)
+    return TaskSpec(
+        benchmark=benchmark,
+        benchmark_file=benchmark_file,
+        output_dir=os.path.join("wasp-out", bench_dirname, bench_basename),
+        bench_dirname=bench_dirname,
+        bench_basename=bench_basename
     )
-    result = execute(benchmark_file, output_dir, backend, prop)
-    lock.acquire()
-    table.add_row([
-        benchmark_file,
+
+
+def init_worker(conf):
+    global worker_conf
+    worker_conf = conf
+    # workers live for the whole run; run_benchmark creates no reference
+    # cycles, so the cyclic collector would only add pauses
+    gc.disable()
+
+
+def run_benchmark(task):
+    result = execute(task.benchmark_file, task.output_dir,
+                     worker_conf["backend"], worker_conf["prop"])
+    return [
+        task.benchmark_file,
         result["answer"],
         result["runtime"],
         result["solver_time"],
         result["paths_explored"]
-    ])
-    lock.release()
+    ]
+
+
+def write_results(table, results_q, size, errors):
+    prev, curr = 0, 0
+    last_print = time.monotonic()
+    try:
+        while True:
+            item = results_q.get()
+            if item is None:
+                break
+            curr += 1
+            table.add_row(item)
+            now = time.monotonic()
+            if now - last_print > PROGRESS_INTERVAL or curr == size:
+                table.commit()
+                prev = progress(f"Ran {item[0]}", curr, size, prev=prev)
+                last_print = now
+    except Exception as e:
+        errors.append(e)
 
 
 def run_tasks(tasks, args):
-    global prev
-    global curr
     info("Starting Test-Comp Benchmarks...")
     info(f"property={args.property}, jobs={args.jobs}")
 
-    if not os.path.exists(args.results):
-        os.makedirs(args.results)
+    os.makedirs(args.results, exist_ok=True)
 
     n_tasks = []
-    for _, benchmarks in tasks.items():
-        n_tasks += benchmarks
-    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
-        info("Analysing Test-Comp benchmarks.", prefix="\n")
-        table = CSVTableGenerator(
-            file=os.path.join(args.results, "all.csv"),
-            header=["test", "answer", "t_backend", "t_solver", "paths"]
-        )
-        lock = Lock()
-        size, prev, curr = len(n_tasks), 0, 0
-        conf = {
-                "prop": args.property,
-                "size": size,
-                "backend": args.backend,
-                "table": table,
-        }
-        results = executor.map(lambda b : run_benchmark(lock, conf, b), n_tasks)
-        for _ in results:
-            pass
+    benchmarks = dict.fromkeys(itertools.chain.from_iterable(tasks.values()))
+    for benchmark in benchmarks:
+        task = get_task(benchmark, args.property)
+        if task is not None:
+            n_tasks.append(task)
+    for d in {os.path.dirname(task.output_dir) for task in n_tasks}:
+        os.makedirs(d, exist_ok=True)
+    info("Analysing Test-Comp benchmarks.", prefix="\n")
+    table = CSVTableGenerator(
+        file=os.path.join(args.results, "all.csv"),
+        header=["test", "answer", "t_backend", "t_solver", "paths"]
+    )
+    results_q = queue.Queue()
+    errors = []
+    writer = threading.Thread(target=write_results,
+                              args=(table, results_q, len(n_tasks), errors))
+    conf = {
+            "prop": args.property,
+            "backend": args.backend,
+    }
+    executor = ProcessPoolExecutor(max_workers=args.jobs,
+                                   initializer=init_worker,
+                                   initargs=(conf,))
+    with table, executor:
+        # submit before starting the writer so that workers are never
+        # forked from a process with a live thread
+        futures = {executor.submit(run_benchmark, task): task
+                   for task in n_tasks}
+        writer.start()
+        try:
+            for future in as_completed(futures):
+                try:
+                    row = future.result()
+                except Exception as e:
+                    benchmark_file = futures[future].benchmark_file
+                    warn(f"{benchmark_file}: {e!r}", prefix="\n")
+                    row = [benchmark_file, "Error", 0.0, 0.0, 0]
+                results_q.put(row)
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+        finally:
+            results_q.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
 
     return 0
 
 
 def validate(conf):
-    (bench, args) = conf
-    bench_conf = parse_yaml(bench)
-    skip = True
-    for prp in bench_conf["properties"]:
-        prop_name = os.path.basename(args.property)
-        prp_name = os.path.basename(prp["property_file"])
-        if prop_name == prp_name:
-            skip = False
-            break
-    if skip:
-        return 1
-    benchmark_file = os.path.join(os.path.dirname(bench),
-                                  bench_conf["input_files"])
+    (task, args) = conf
     testsuite = os.path.join(
         args.validate,
-        os.path.basename(os.path.dirname(benchmark_file)),
-        os.path.basename(benchmark_file),
+        task.bench_dirname,
+        task.bench_basename,
         "test-suite"
     )
     if not os.path.exists(testsuite):
@@ -335,36 +418,67 @@ def validate(conf):
     # zip test-suite
     testcases = glob.glob(os.path.join(testsuite, "*.xml"))
     testsuite = os.path.join(testsuite, "test-suite.zip")
-    with ZipFile(testsuite, "w") as zip_file:
+    with ZipFile(testsuite, "w", compression=ZIP_DEFLATED,
+                 compresslevel=1) as zip_file:
         for testcase in testcases:
-            zip_file.write(testcase)
-    output_dir = os.path.join("val-out", bench)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    subprocess.run(
-        [
-            "test-suite-validator/bin/testcov", benchmark_file,
-            "--no-plots",
-            "--no-isolation",
-            "--memlimit", "6GB",
-            "--timelimit-per-run", "50",
-            "--test-suite", testsuite,
-            "--output", output_dir
-        ],
-        check=True
-    )
-    aux_file = "instrumented_" + os.path.basename(benchmark_file) + ".gcov"
+            zip_file.write(testcase, arcname=os.path.join(
+                "test-suite", os.path.basename(testcase)))
+    output_dir = os.path.join("val-out", task.benchmark)
+    os.makedirs(output_dir, exist_ok=True)
+    testcov = "test-suite-validator/bin/testcov"
+    pid = os.posix_spawn(testcov, [
+        testcov, task.benchmark_file,
+        "--no-plots",
+        "--no-isolation",
+        "--memlimit", "6GB",
+        "--timelimit-per-run", "50",
+        "--test-suite", testsuite,
+        "--output", output_dir
+    ], os.environ)
+    _, status = os.waitpid(pid, 0)
+    code = os.waitstatus_to_exitcode(status)
+    if code != 0:
+        warn(f"testcov exited with {code} on {task.benchmark_file}")
+    aux_file = "instrumented_" + task.bench_basename + ".gcov"
     if os.path.exists(aux_file):
         os.remove(aux_file)
-    return 0
+    return 0 if code == 0 else 1
+
+
+def validate_group(conf):
+    (group, args) = conf
+    return [validate((task, args)) for task in group]
 
 
 def validate_tasks(tasks, args):
     info("Starting Test-Comp validation...")
-    info(f"property={args.property}")
+    info(f"property={args.property}, jobs={args.jobs}")
+    v_tasks = {}
     for cat, benchmarks in tasks.items():
-        info(f"Validating \"{cat}\"...", prefix="\n")
-        list(map(validate, [(bench, args) for bench in benchmarks]))
+        # tasks sharing an input file share its test-suite directory
+        cat_tasks = {}
+        for benchmark in benchmarks:
+            task = get_task(benchmark, args.property)
+            if task is not None:
+                key = (task.bench_dirname, task.bench_basename)
+                cat_tasks.setdefault(key, task)
+        v_tasks[cat] = list(cat_tasks.values())
+    parents = set()
+    for cat_tasks in v_tasks.values():
+        parents.update(os.path.dirname(os.path.join("val-out", t.benchmark))
+                       for t in cat_tasks)
+    for d in parents:
+        os.makedirs(d, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for cat, cat_tasks in v_tasks.items():
+            info(f"Validating \"{cat}\"...", prefix="\n")
+            # testcov leaves instrumented_<basename>.gcov in the cwd, so
+            # tasks sharing a basename are validated one at a time
+            groups = {}
+            for task in cat_tasks:
+                groups.setdefault(task.bench_basename, []).append(task)
+            list(executor.map(validate_group,
+                              [(group, args) for group in groups.values()]))
     return 0
 
 